@@ -0,0 +1,264 @@
+# Offline benchmark for invocations, run from the bot's directory with `python bench.py`.
+# TIO and ATO are replaced by local servers speaking their protocols, and Discord by fake messages,
+# so no token or network access is needed. Programs are written in a tiny language understood by both servers:
+#   sleep SECONDS     wait before continuing
+#   print BYTES       output that many bytes
+#   anything else     is echoed back
+import argparse
+import asyncio
+import itertools
+import resource
+import time
+import zlib
+
+import aiohttp
+import msgpack
+from aiohttp import web
+
+import main
+import sources
+from sources import tio, ato
+from invocation import Invocation, STDOUT
+from outputter import StandardOutputter
+
+
+# simulated round trip for each Discord API call
+DISCORD_LATENCY = 0.02
+DELIMITER = b"0123456789abcdef"
+
+ids = itertools.count(1 << 40)
+
+
+def run_program(code):
+    for line in code.decode().splitlines():
+        match line.split():
+            case ["sleep", seconds]:
+                yield float(seconds)
+            case ["print", size]:
+                for start in range(0, int(size), 1 << 16):
+                    yield (b"x" * 79 + b"\n") * (min(1 << 16, int(size) - start) // 80)
+            case _:
+                yield line.encode() + b"\n"
+
+
+def parse_tio(body):
+    data = zlib.decompress(body, -zlib.MAX_WBITS)
+    files = {}
+    i = 0
+    while data[i:i+1] != b"R":
+        kind = data[i:i+1]
+        name, count, rest = data[i+1:].split(b"\x00", 2)
+        i += 1 + len(name) + len(count) + 2
+        if kind == b"V":
+            for _ in range(int(count)):
+                i = data.index(b"\x00", i) + 1
+        else:
+            files[name] = data[i:i+int(count)]
+            i += int(count) + 1
+    return files
+
+
+async def tio_handler(request):
+    files = parse_tio(await request.read())
+    start = time.monotonic()
+    output = bytearray()
+    for part in run_program(files[b".code.tio"]):
+        if isinstance(part, float):
+            await asyncio.sleep(part)
+        else:
+            output += part
+    stats = f"\n\nReal time: {time.monotonic() - start:.3f} s\nUser time: 0.001 s\nSys. time: 0.001 s\nCPU share: 1.00 %\nExit code: 0"
+    return web.Response(body=DELIMITER + output + DELIMITER + stats.encode())
+
+
+async def ato_handler(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    msg = msgpack.unpackb((await ws.receive()).data)
+    start = time.monotonic()
+    for part in run_program(msg["code"]):
+        if isinstance(part, float):
+            await asyncio.sleep(part)
+        else:
+            await ws.send_bytes(msgpack.packb({"Stdout": part}))
+    real = int((time.monotonic() - start) * 1e9)
+    await ws.send_bytes(msgpack.packb({"Done": {
+        "timed_out": False, "status_type": "exited", "status_value": 0,
+        "real": real, "user": 1000000, "kernel": 1000000, "max_mem": 1024,
+    }}))
+    await ws.close()
+    return ws
+
+
+async def serve():
+    app = web.Application(client_max_size=1 << 30)
+    app.router.add_post("/tio", tio_handler)
+    app.router.add_get("/ato", ato_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+class FakeDiscord:
+    def __init__(self):
+        self.calls = 0
+
+    async def call(self):
+        self.calls += 1
+        await asyncio.sleep(DISCORD_LATENCY)
+
+
+class FakeUser:
+    def __init__(self, id, bot=False):
+        self.id = id
+        self.bot = bot
+
+
+class FakeGuild:
+    def __init__(self, id, me):
+        self.id = id
+        self.me = me
+
+
+class FakeChannel:
+    def __init__(self, discord, guild):
+        self.discord = discord
+        self.id = next(ids)
+        self.guild = guild
+        self.last_message_id = None
+
+    async def send(self, content="", **kwargs):
+        await self.discord.call()
+        return FakeMessage(self, self.guild.me, content)
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content):
+        self.id = next(ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        channel.last_message_id = self.id
+
+    def edited(self, content):
+        new = object.__new__(FakeMessage)
+        new.__dict__.update(self.__dict__, content=content)
+        return new
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.discord.call()
+        if content is not None:
+            self.content = content
+
+    async def delete(self):
+        await self.channel.discord.call()
+
+    async def add_reaction(self, emoji):
+        await self.channel.discord.call()
+
+    async def remove_reaction(self, emoji, member):
+        await self.channel.discord.call()
+
+    async def clear_reactions(self):
+        await self.channel.discord.call()
+
+
+def codeblock(code):
+    return f"```bench\n{code}\n```"
+
+
+async def invoke(message):
+    await main.execute(Invocation(main.session, message, *main.parse_text(message), outputter=StandardOutputter(message)))
+
+
+async def timed(coro):
+    start = time.monotonic()
+    await coro
+    return time.monotonic() - start
+
+
+async def burst(channel, users, n):
+    messages = [FakeMessage(channel, users[i % len(users)], codeblock(f"sleep 0.05\nrun {i}")) for i in range(n)]
+    return await asyncio.gather(*(timed(invoke(m)) for m in messages))
+
+
+async def edits(channel, users, n):
+    message = FakeMessage(channel, users[0], codeblock("sleep 0.05\nfirst"))
+    latencies = [await timed(invoke(message))]
+    tasks = []
+    for i in range(n):
+        after = message.edited(codeblock(f"sleep 0.05\nedit {i}"))
+        tasks.append(asyncio.ensure_future(timed(main.on_message_edit(message, after))))
+        await asyncio.sleep(0.05)
+    latencies += await asyncio.gather(*tasks)
+    return latencies
+
+
+async def huge(channel, users, n):
+    messages = [FakeMessage(channel, users[i % len(users)], codeblock(f"print {8 << 20}\nrun {i}")) for i in range(n)]
+    return await asyncio.gather(*(timed(invoke(m)) for m in messages))
+
+
+async def reactions(channel, users, n):
+    message = FakeMessage(channel, users[0], codeblock("print 200\nreactions"))
+    await invoke(message)
+    return await asyncio.gather(*(timed(main.jostle(STDOUT, channel.id, message.id, users[0].id, i % 2 == 0)) for i in range(n)))
+
+
+SCENARIOS = {
+    "burst": burst,
+    "edits": edits,
+    "huge": huge,
+    "reactions": reactions,
+}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def bench(names, n, backend):
+    runner, port = await serve()
+    tio.URL = f"http://127.0.0.1:{port}/tio"
+    ato.URL = f"ws://127.0.0.1:{port}/ato"
+    sources.snapshot.clear()
+    sources.snapshot.update({"tio": {"data": {"bench": {"name": "Bench"}}}, "ato": {"data": {"bench": {"name": "Bench"}}}})
+    sources.SOURCES = (tio, ato)
+    sources.languages, sources.backends = sources.build()
+    if backend:
+        sources.backends["bench"] = [l for l in sources.backends["bench"] if l.runner == backend]
+
+    discord = FakeDiscord()
+    bot_user = FakeUser(1, bot=True)
+    guild = FakeGuild(1, bot_user)
+    channel = FakeChannel(discord, guild)
+    users = [FakeUser(100 + i) for i in range(10)]
+
+    async with aiohttp.ClientSession() as main.session:
+        for name in names:
+            calls = discord.calls
+            start = time.monotonic()
+            latencies = await SCENARIOS[name](channel, users, n)
+            elapsed = time.monotonic() - start
+            print(
+                f"{name:<10} {len(latencies) / elapsed:8.1f}/s"
+                f"  p50 {percentile(latencies, 0.5) * 1000:8.1f}ms  p99 {percentile(latencies, 0.99) * 1000:8.1f}ms"
+                f"  discord calls {discord.calls - calls:5}"
+                f"  peak rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB"
+            )
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark invocations against local stand-ins for TIO, ATO and Discord.")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)}, or all of them by default")
+    parser.add_argument("-n", type=int, default=50, help="size of each scenario")
+    parser.add_argument("--backend", choices=["with TIO", "with ATO"], help="only use this backend")
+    args = parser.parse_args()
+    if unknown := [s for s in args.scenarios if s not in SCENARIOS]:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+    asyncio.run(bench(args.scenarios or list(SCENARIOS), args.n, args.backend))
@@ -0,0 +1,37 @@
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    def __init__(self, maxsize=256, maxbytes=32 << 20, ttl=600):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if entry := self.entries.get(key):
+            expires, size, value = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.pop(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, value, size=0):
+        if size > self.maxbytes:
+            return
+        self.pop(key)
+        self.entries[key] = time.monotonic() + self.ttl, size, value
+        self.size += size
+        while len(self.entries) > self.maxsize or self.size > self.maxbytes:
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, key):
+        if entry := self.entries.pop(key, None):
+            self.size -= entry[1]
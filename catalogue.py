@@ -0,0 +1,67 @@
+from collections import Counter, defaultdict
+
+import sources
+from langdata import ALIASES
+
+
+def grams(s):
+    s = f" {s} "
+    return {s[i:i+2] for i in range(len(s) - 1)}
+
+
+class Index:
+    def __init__(self, languages, aliases):
+        self.languages = languages
+        # codeblock tag -> Language, with aliases taking priority like they always have
+        self.table = dict(languages)
+        for alias, key in aliases.items():
+            if key in languages:
+                self.table[alias] = languages[key]
+            else:
+                self.table.pop(alias, None)
+        # lowercased id, display name or alias -> ids it refers to
+        self.terms = defaultdict(set)
+        for key, lang in languages.items():
+            self.terms[key.lower()].add(key)
+            self.terms[lang.name.lower()].add(key)
+        for alias, key in aliases.items():
+            if key in languages:
+                self.terms[alias.lower()].add(key)
+        self.grams = defaultdict(set)
+        for term in self.terms:
+            for g in grams(term):
+                self.grams[g].add(term)
+
+    def resolve(self, tag):
+        return self.table.get(tag)
+
+    def search(self, query, *, fuzziness=0.4):
+        query = query.lower()
+        wanted = grams(query)
+        shared = Counter(term for g in wanted for term in self.grams.get(g, ()))
+        if len(query) < 2 or not shared:
+            # too short to share a bigram with the middle of a term, so scan for it instead
+            shared.update(term for term in self.terms if query in term)
+        scores = {}
+        for term, count in shared.items():
+            if term == query:
+                score = 4
+            elif term.startswith(query):
+                score = 3
+            elif query in term:
+                score = 2
+            elif (score := count / len(wanted | grams(term))) < fuzziness:
+                continue
+            for key in self.terms[term]:
+                scores[key] = max(scores.get(key, 0), score)
+        return sorted(scores, key=lambda k: (-scores[k], k))
+
+
+current = None
+
+def index():
+    # rebuilt whenever sources swaps in a new catalogue
+    global current
+    if not current or current.languages is not sources.languages:
+        current = Index(sources.languages, ALIASES)
+    return current
@@ -3,8 +3,14 @@ import datetime
 import discord
 import shlex
 import io
+import time
 
+import metrics
 import sources
+import tracing
+from cache import ResultCache
+from langdata import UNCACHED
+from scheduler import scheduler, QueueFull
 
 
 SUCCESS = "<a:success:1394931188501581844>"
@@ -14,15 +20,44 @@ OOM = "<a:oom:1394931248350232647>"
 STDOUT = "<a:stdout:1394931226535788585>"
 STDERR = "<a:stderr:1394929989555720242>"
 RUNNING = "<a:running:1394931166443999283>"
+QUEUED = "\N{HOURGLASS WITH FLOWING SAND}"
 
+# partial output is shown while programs run, editing at most once per STREAM_INTERVAL seconds
+STREAM = True
+STREAM_INTERVAL = 1.5
+# output is shown inline when it fits in ROWS rows of 90 characters, which no more than INLINE_MAX bytes can
+ROWS = 11
+INLINE_MAX = 4 * ROWS * 90 + 2 * ROWS
+# output bigger than this is turned into a file off the event loop
+THREAD_THRESHOLD = 1 << 16
 
-def render(b, name, *, file=False, codeblock=False):
+cache = ResultCache()
+metrics.Gauge("gce_cache_hits", "Executions answered from the result cache.", lambda: cache.hits)
+metrics.Gauge("gce_cache_misses", "Executions not found in the result cache.", lambda: cache.misses)
+# key -> [task, number of invocations waiting on it] for programs currently running
+inflight = {}
+
+
+def inline(b):
+    # anything too big to fit is never decoded at all
+    if len(b) > INLINE_MAX:
+        return None
     try:
-        out = b.decode()
+        out = bytes(b).decode()
     except UnicodeDecodeError:
-        out = None
-    if file or out is None or sum(1 + len(x) // 90 for x in out.splitlines()) > 11:
-        return discord.File(io.BytesIO(b), f"{name}.txt")
+        return None
+    rows = 0
+    for line in out.splitlines():
+        rows += 1 + len(line) // 90
+        if rows > ROWS:
+            return None
+    return out
+
+async def render(b, name, *, file=False, codeblock=False):
+    if file or (out := inline(b)) is None:
+        data = await asyncio.to_thread(bytes, b) if len(b) > THREAD_THRESHOLD else bytes(b)
+        # BytesIO shares the bytes it's given rather than copying them
+        return discord.File(io.BytesIO(data), f"{name}.txt")
     if codeblock:
         out = out.replace('```', '`\u200b``')
         out = f"```\n\u200b{out}```"
@@ -33,7 +68,7 @@ def attr(e):
 
 
 class Invocation:
-    def __init__(self, session, message, lang, code, *, outputter, stdin="", options=(), args=()):
+    def __init__(self, session, message, lang, code, *, outputter, stdin="", options=(), args=(), trace=None):
         self.session = session
         self.lang = lang
         self.message = message
@@ -42,37 +77,122 @@ class Invocation:
         self.stdin = stdin
         self.options = options
         self.args = args
-        self.stdout = b""
-        self.stderr = b""
+        self.stdout = sources.OutputBuffer()
+        self.stderr = sources.OutputBuffer()
         self.success = sources.FAILED
+        # the backend that actually ran the program, out of those offering the language
+        self.backend = None
+        # resources the program used, as far as its backend reports them
+        self.usage = None
+        self.output_event = asyncio.Event()
+        self.started = asyncio.Event()
+        self.state = None
+        self.queue_time = 0
+        self.run_time = None
+        self.partial = None
+        self.task = None
+        self.trace = trace or tracing.Trace()
+
+    def output_received(self):
+        self.output_event.set()
+
+    def result(self):
+        return self.stdout, self.stderr, self.success, self.backend, self.usage
+
+    def adopt(self, result):
+        self.stdout, self.stderr, self.success, self.backend, self.usage = result
+
+    def key(self):
+        return self.lang.id, self.lang.runner, self.code, self.stdin, tuple(self.options), tuple(self.args)
+
+    async def queued(self):
+        self.state = "queued"
+        if hasattr(self.outputter, "set_reactions"):
+            await self.outputter.set_reactions([QUEUED])
+        elif self.outputter.can_edit():
+            await self.outputter.edit(content="Queued...")
+
+    async def schedule(self, backend=None):
+        start = time.monotonic()
+        try:
+            self.backend = backend or sources.route(self.lang.id)[0]
+            async with scheduler.slot(self, self.queued):
+                self.trace.add("schedule", start, time.monotonic(), runner=self.backend.runner)
+                self.state = "running"
+                self.started.set()
+                start = time.monotonic()
+                # a backend that was asked for specifically is used alone
+                with self.trace.span("execute"):
+                    await (sources.attempt(self) if backend else self.lang.execute(self))
+                self.run_time = time.monotonic() - start
+        except (QueueFull, sources.Unavailable):
+            self.state = "rejected"
+            raise
+
+    async def share(self, key):
+        try:
+            await self.schedule()
+        finally:
+            del inflight[key]
+        # timeouts are usually down to load, so they're worth retrying
+        if self.success != sources.TIMEOUT:
+            cache.put(key, self.result(), len(self.stdout) + len(self.stderr))
+        return self.result()
+
+    async def measure(self, backend):
+        # runs on the given backend without the cache or any output, for timing
+        await self.schedule(backend)
+        return self
+
+    async def run(self):
+        if self.lang.id in UNCACHED:
+            return await self.schedule()
+        key = self.key()
+        if hit := cache.get(key):
+            self.adopt(hit)
+            self.trace.add("cache", time.monotonic(), time.monotonic())
+            return
+        # identical programs that are already running are waited on instead of being run again
+        if not (flight := inflight.get(key)):
+            flight = inflight[key] = [asyncio.get_running_loop().create_task(self.share(key)), 0]
+        flight[1] += 1
+        try:
+            self.adopt(await asyncio.shield(flight[0]))
+        except asyncio.CancelledError:
+            flight[1] -= 1
+            if not flight[1]:
+                flight[0].cancel()
+            raise
 
     async def send_public_message(self, content="", embed=None, files=None):
         if not (content.strip() or embed or files):
             await self.outputter.delete()
             return
 
-        if self.outputter.can_edit():
-            return await self.outputter.edit(content=content, embed=embed, attachments=files)
+        with self.trace.span("send_public_message"):
+            if self.outputter.can_edit():
+                return await self.outputter.edit(content=content, embed=embed, attachments=files)
 
-        await self.outputter.send(content, embed=embed, files=files, reference=self.message if self.message.channel.last_message_id != self.message.id else None, mention_author=False)
+            await self.outputter.send(content, embed=embed, files=files, reference=self.message if self.message.channel.last_message_id != self.message.id else None, mention_author=False)
 
     async def send_output(self):
         texts = []
         files = []
 
-        if self.send_stdout:
-            s = render(self.stdout, "stdout")
-            if isinstance(s, discord.File):
-                files.append(s)
-            else:
-                texts.append(s)
+        with self.trace.span("render"):
+            if self.send_stdout:
+                s = await render(self.stdout, "stdout")
+                if isinstance(s, discord.File):
+                    files.append(s)
+                else:
+                    texts.append(s)
 
-        if self.send_stderr:
-            s = render(self.stderr, "stderr", file=files, codeblock=True)
-            if isinstance(s, discord.File):
-                files.append(s)
-            else:
-                texts.append(s)
+            if self.send_stderr:
+                s = await render(self.stderr, "stderr", file=files, codeblock=True)
+                if isinstance(s, discord.File):
+                    files.append(s)
+                else:
+                    texts.append(s)
 
         if len(texts) == 2 or self.stdin or self.options or self.args:
             text = ""
@@ -94,24 +214,64 @@ class Invocation:
 
         await self.send_public_message(text, embed=embed, files=files)
 
+    async def send_partial(self):
+        if not self.stdout:
+            return
+        if (out := inline(self.stdout)) is not None:
+            await self.send_public_message(out, files=[])
+
+    def record(self, start):
+        runner = self.backend.runner if self.backend else "none"
+        metrics.invocations.inc(runner=runner, language=self.lang.id, outcome=sources.OUTCOMES[self.success])
+        metrics.invocation_seconds.observe(time.monotonic() - start, runner=runner)
+        metrics.output_bytes.observe(self.stdout.total, stream="stdout")
+        metrics.output_bytes.observe(self.stderr.total, stream="stderr")
+        self.trace.emit(message=self.message.id, language=self.lang.id, runner=runner, outcome=sources.OUTCOMES[self.success])
+
     async def _execute(self):
+        start = time.monotonic()
         loop = asyncio.get_event_loop()
         me = self.message.guild.me
-        can_react = hasattr(self.outputter, "add_reaction")
+        can_react = hasattr(self.outputter, "set_reactions")
 
         async def running():
             # wait a bit for quick programs to finish right away without wasting time reacting
             await asyncio.sleep(2)
+            await self.started.wait()
 
-            await self.outputter.clear_reactions()
-            await self.outputter.add_reaction(RUNNING)
+            if can_react:
+                await self.outputter.set_reactions([RUNNING])
 
-            if self.outputter.can_edit():
-                await self.outputter.edit(content="Message edited. Recalculating...", embed=None, attachments=[])
+                if self.outputter.can_edit():
+                    await self.outputter.edit(content="Message edited. Recalculating...", embed=None, attachments=[])
+
+            while STREAM:
+                await self.output_event.wait()
+                self.output_event.clear()
+                # shielded so that finishing never interrupts a send halfway and loses track of the message
+                self.partial = loop.create_task(self.send_partial())
+                await asyncio.shield(self.partial)
+                await asyncio.sleep(STREAM_INTERVAL)
 
-        send_running = loop.create_task(running() if can_react else asyncio.sleep(0))
-        await self.lang.execute(self)
-        send_running.cancel()
+        send_running = loop.create_task(running())
+        try:
+            await self.run()
+        except (QueueFull, sources.BackendError) as e:
+            send_running.cancel()
+            if can_react:
+                await self.outputter.set_reactions([])
+            await self.send_public_message(str(e))
+            self.record(start)
+            return
+        except asyncio.CancelledError:
+            # superseded, and the outputter may already belong to the invocation that replaced this one
+            if self.partial:
+                self.partial.cancel()
+            raise
+        finally:
+            send_running.cancel()
+        if self.partial:
+            await asyncio.gather(self.partial, return_exceptions=True)
 
         is_stdout = bool(self.stdout)
         is_stderr = bool(self.stderr)
@@ -121,21 +281,22 @@ class Invocation:
             self.send_stderr = False
 
             async def send_reactions():
-                await self.outputter.clear_reactions()
-
                 if self.success == sources.SUCCESS:
-                    await self.outputter.add_reaction(SUCCESS)
+                    reactions = [SUCCESS]
                 elif self.success == sources.TIMEOUT:
-                    await self.outputter.add_reaction(TIMED_OUT)
+                    reactions = [TIMED_OUT]
                 elif self.success == sources.OOM:
-                    await self.outputter.add_reaction(OOM)
+                    reactions = [OOM]
                 else:
-                    await self.outputter.add_reaction(FAILED)
+                    reactions = [FAILED]
 
                 if self.success != sources.SUCCESS and is_stdout:
-                    await self.outputter.add_reaction(STDOUT)
+                    reactions.append(STDOUT)
                 if is_stderr:
-                    await self.outputter.add_reaction(STDERR)
+                    reactions.append(STDERR)
+
+                with self.trace.span("reactions"):
+                    await self.outputter.set_reactions(reactions)
 
             async with asyncio.TaskGroup() as tg:
                 tg.create_task(send_reactions())
@@ -145,6 +306,8 @@ class Invocation:
             self.send_stderr = is_stderr
             await self.send_output()
 
+        self.record(start)
+
     async def execute(self):
         self.task = task = asyncio.get_event_loop().create_task(self._execute())
         await task
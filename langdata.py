@@ -22,3 +22,10 @@ ALIASES = {
     "cr": "crystal",
     "clj": "clojure",
 }
+
+# languages whose output commonly differs between runs of the same program, so results are never cached
+UNCACHED = {
+    "bash",
+    "zsh",
+    "powershell",
+}
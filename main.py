@@ -1,20 +1,36 @@
 import aiohttp
+import asyncio
+import os
 import time
 import re
 import shlex
-from typing import Optional
+import statistics
+from collections import OrderedDict
+from typing import Literal, Optional
 
 import discord
 from discord.ext import commands
 from parse_discord import parse, Codeblock
 
 import sources
-from outputter import StandardOutputter, InteractionOutputter
+import catalogue
+import metrics
+import tracing
+import supervisor
+from outputter import StandardOutputter, InteractionOutputter, NullOutputter
 from invocation import Invocation, attr
-from langdata import ALIASES
+from scheduler import QueueFull
+from store import Record, results, shared
 
 
-bot = commands.Bot(
+# set by the supervisor for each process when the bot's shards are split between several
+shards = {}
+if "GCE_SHARDS" in os.environ:
+    first, last = map(int, os.environ["GCE_SHARDS"].split("-"))
+    shards = {"shard_ids": list(range(first, last + 1)), "shard_count": int(os.environ["GCE_SHARD_COUNT"])}
+
+bot = (commands.AutoShardedBot if shards else commands.Bot)(
+    **shards,
     command_prefix="gce!",
     help_command=None,
     intents=discord.Intents(
@@ -25,78 +41,174 @@ bot = commands.Bot(
     ),
     allowed_mentions=discord.AllowedMentions.none(),
 )
-results = {}
+
+# edits to a message within this many seconds of each other are acted on together
+DEBOUNCE = 1.0
+pending_edits = {}
+# (message id, fenced parts of its content) -> (language tag, code) for each of its codeblocks
+PARSE_CACHE_SIZE = 1024
+parsed = OrderedDict()
+# message id -> whether its output needs rendering again once the render in progress is done
+rerender = {}
 
 
 @bot.event
 async def on_ready():
     print(f"Ready on {bot.user}")
 
-def parse_text(msg):
+def codeblocks(msg):
     text = msg.content
+    # most messages have no codeblock at all, and aren't worth parsing
+    if "```" not in text:
+        return []
     if msg.author.id in (261243340752814085, 179957318941671424) and "gce" not in text.lower():
-        return None
-    for m in parse(text).walk():
-        if not isinstance(m, Codeblock):
-            continue
-        if not m.language:
-            continue
-        lang = ALIASES.get(m.language, m.language)
-        code = m.content.encode() + b"\n"
-        if l := sources.languages.get(lang):
-            return l, code
+        return []
+    # edits that only touch the text around the code don't need parsing again
+    key = msg.id, tuple(re.findall(r"```.*?```", text, re.DOTALL))
+    if (blocks := parsed.get(key)) is None:
+        blocks = parsed[key] = [(m.language, m.content) for m in parse(text).walk() if isinstance(m, Codeblock) and m.language]
+        if len(parsed) > PARSE_CACHE_SIZE:
+            parsed.popitem(last=False)
+    else:
+        parsed.move_to_end(key)
+    return blocks
+
+def parse_text(msg):
+    resolve = catalogue.index().resolve
+    for tag, content in codeblocks(msg):
+        if l := resolve(tag):
+            return l, content.encode() + b"\n"
     return None
 
+def traced(msg):
+    # parsing happens before there's an invocation to hold the trace
+    trace = tracing.Trace()
+    with trace.span("parse_text"):
+        m = parse_text(msg)
+    return m, trace
+
+def suggest(msg):
+    for tag, _ in codeblocks(msg):
+        if found := catalogue.index().search(tag):
+            return f"There's no language called `{tag}`. Did you mean `{found[0]}`?"
+    return "There's no code in this message."
+
 async def execute(inv):
     results[inv.message.id] = inv
     await inv.execute()
+    if results.get(inv.message.id) is inv:
+        results[inv.message.id] = record = Record(inv)
+        if shared:
+            shared.put(inv.message.id, record)
+
+async def lookup(channel_id, message_id, message=None, *, output=False):
+    if inv := results.get(message_id):
+        return inv
+    # the invocation may have been run by another process, or by an earlier run of this one
+    if not shared:
+        return None
+    if not (data := await shared.get(message_id)):
+        # the message may instead be the output of one
+        if not output or not (found := await shared.source(message_id)):
+            return None
+        message_id, data = found
+        message = None
+        if inv := results.get(message_id):
+            return inv
+    if not message:
+        try:
+            message = await bot.get_partial_messageable(channel_id).fetch_message(message_id)
+        except discord.HTTPException:
+            return None
+    if record := Record.load(data, message):
+        results[message_id] = record
+    return record
 
 @bot.event
 async def on_message(message):
-    await bot.process_commands(message)
-    if message.author.bot or not message.guild:
+    ctx = await bot.get_context(message)
+    if not message.author.bot:
+        await bot.invoke(ctx)
+    # codeblocks given to commands are theirs to deal with
+    if ctx.valid or message.author.bot or not message.guild:
         return
-    if m := parse_text(message):
-        await execute(Invocation(session, message, *m, outputter=StandardOutputter(message)))
+    m, trace = traced(message)
+    if m:
+        await execute(Invocation(session, message, *m, outputter=StandardOutputter(message), trace=trace))
 
 async def delete(message):
-    if inv := results.get(message.id):
-        del results[message.id]
+    await lookup(message.channel.id, message.id, message)
+    if inv := results.pop(message.id):
+        if shared:
+            shared.delete(message.id)
         await inv.outputter.delete()
 
+async def settle(message_id):
+    if task := pending_edits.get(message_id):
+        task.cancel()
+    pending_edits[message_id] = task = asyncio.ensure_future(asyncio.sleep(DEBOUNCE))
+    try:
+        await task
+        return True
+    except asyncio.CancelledError:
+        return False
+    finally:
+        if pending_edits.get(message_id) is task:
+            del pending_edits[message_id]
+
 @bot.event
 async def on_message_edit(before, after):
     if after.author.bot or not after.guild:
         return
-    inv = results.get(after.id)
-    if m := parse_text(after):
+    if not await settle(after.id):
+        # a newer edit superseded this one
+        return
+    if after.content.startswith(bot.command_prefix) and (await bot.get_context(after)).valid:
+        return
+    inv = await lookup(after.channel.id, after.id, after)
+    m, trace = traced(after)
+    if m:
         if not inv or m != (inv.lang, inv.code):
             if inv:
-                inv.task.cancel()
-                inv = Invocation(session, after, *m, stdin=inv.stdin, args=inv.args, options=inv.options, outputter=inv.outputter)
+                if inv.task:
+                    inv.task.cancel()
+                inv = Invocation(session, after, *m, stdin=inv.stdin, args=inv.args, options=inv.options, outputter=inv.outputter, trace=trace)
             else:
-                inv = Invocation(session, after, *m, outputter=StandardOutputter(after))
+                inv = Invocation(session, after, *m, outputter=StandardOutputter(after), trace=trace)
             await execute(inv)
     elif inv:
-        await after.clear_reactions()
+        await inv.outputter.set_reactions([])
         await delete(after)
 
 @bot.event
 async def on_message_delete(message):
     await delete(message)
 
-async def jostle(emoji, message_id, user_id, value):
-    if (inv := results.get(message_id)) and user_id == inv.message.author.id and (a := attr(emoji)):
+async def jostle(emoji, channel_id, message_id, user_id, value):
+    if (a := attr(emoji)) and (inv := await lookup(channel_id, message_id)) and user_id == inv.message.author.id:
         setattr(inv, a, value)
-        await inv.send_output()
+        if shared and isinstance(inv, Record):
+            shared.put(message_id, inv)
+        # bursts of toggles are coalesced into one render of whatever the latest state is
+        if message_id in rerender:
+            rerender[message_id] = True
+            return
+        rerender[message_id] = False
+        try:
+            await inv.send_output()
+            while rerender[message_id]:
+                rerender[message_id] = False
+                await inv.send_output()
+        finally:
+            del rerender[message_id]
 
 @bot.event
 async def on_raw_reaction_add(payload):
-    await jostle(str(payload.emoji), payload.message_id, payload.user_id, True)
+    await jostle(str(payload.emoji), payload.channel_id, payload.message_id, payload.user_id, True)
 
 @bot.event
 async def on_raw_reaction_remove(payload):
-    await jostle(str(payload.emoji), payload.message_id, payload.user_id, False)
+    await jostle(str(payload.emoji), payload.channel_id, payload.message_id, payload.user_id, False)
 
 
 class Options(discord.ui.Modal, title="Edit options"):
@@ -139,28 +251,96 @@ class Options(discord.ui.Modal, title="Edit options"):
 @bot.tree.context_menu()
 async def invoke(interaction, message: discord.Message):
     ephemeral = message.author.id != interaction.user.id
-    if m := parse_text(message):
+    m, trace = traced(message)
+    if m:
         await interaction.response.defer(ephemeral=ephemeral)
-        await Invocation(session, message, *m, outputter=InteractionOutputter(interaction)).execute()
+        await Invocation(session, message, *m, outputter=InteractionOutputter(interaction), trace=trace).execute()
     else:
-        await interaction.response.send_message("There's no code in this message.", ephemeral=True)
+        await interaction.response.send_message(suggest(message), ephemeral=True)
 
 @bot.tree.context_menu(name="Edit options")
 async def edit_options(interaction, message: discord.Message):
     if message.author.id != interaction.user.id:
         await interaction.response.send_message("This isn't your message.", ephemeral=True)
-    elif inv := results.get(message.id):
+    elif inv := await lookup(message.channel.id, message.id, message):
         await interaction.response.send_modal(Options(inv))
     else:
         await interaction.response.send_message("There's no code in this message.", ephemeral=True)
 
+BENCH_RUNS = 5
+BENCH_MAX_RUNS = 10
+
+def spread(values, unit):
+    if not values:
+        return "unknown"
+    return f"{min(values):.3f}{unit} / {statistics.median(values):.3f}{unit} / {max(values):.3f}{unit}"
+
+async def benchmark(message, lang, code, runs, everywhere):
+    try:
+        backends = sources.route(lang.id)
+    except sources.Unavailable as e:
+        return str(e)
+    if not everywhere:
+        backends = backends[:1]
+    runs_on = [(Invocation(session, message, lang, code, outputter=NullOutputter()), backend) for backend in backends for _ in range(runs)]
+    done = await asyncio.gather(*(inv.measure(backend) for inv, backend in runs_on), return_exceptions=True)
+    if full := next((d for d in done if isinstance(d, QueueFull)), None):
+        return str(full)
+
+    embed = discord.Embed(title=f"{lang.name}, {runs} runs", description="min / median / max")
+    for backend in backends:
+        mine = [d for d in done if isinstance(d, Invocation) and d.backend is backend]
+        usage = [inv.usage for inv in mine if inv.usage]
+        lines = [
+            f"Wall time: {spread([inv.run_time for inv in mine], 's')}",
+            f"CPU time: {spread([u.cpu for u in usage if u.cpu is not None], 's')}",
+            f"Memory: {spread([u.memory / 1024 for u in usage if u.memory is not None], ' MiB')}",
+        ]
+        if failed := runs - sum(inv.success == sources.SUCCESS for inv in mine):
+            lines.append(f"{failed} of {runs} runs didn't succeed")
+        embed.add_field(name=backend.runner.capitalize(), value="\n".join(lines), inline=False)
+    return embed
+
+@bot.command(name="bench")
+async def bench_command(ctx, runs: Optional[int] = BENCH_RUNS, everywhere: Optional[Literal["all"]] = None, *, code=None):
+    """Time a codeblock over several runs, optionally on every backend that has its language."""
+    if not (m := parse_text(ctx.message)):
+        return await ctx.send("There's no code in this message.")
+    async with ctx.typing():
+        embed = await benchmark(ctx.message, *m, max(1, min(runs, BENCH_MAX_RUNS)), bool(everywhere))
+    if isinstance(embed, str):
+        await ctx.send(embed)
+    else:
+        await ctx.send(embed=embed)
+
+@bot.tree.context_menu(name="Benchmark")
+async def benchmark_menu(interaction, message: discord.Message):
+    if not (m := parse_text(message)):
+        return await interaction.response.send_message(suggest(message), ephemeral=True)
+    await interaction.response.defer(ephemeral=True)
+    embed = await benchmark(message, *m, BENCH_RUNS, True)
+    if isinstance(embed, str):
+        await interaction.followup.send(embed, ephemeral=True)
+    else:
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
 @bot.tree.context_menu()
 async def info(interaction, message: discord.Message):
-    if inv := results.get(message.id):
-        await interaction.response.send_message(f"Executed {inv.lang.runner} as {inv.lang.name}.", ephemeral=True)
+    if inv := await lookup(message.channel.id, message.id, message, output=True):
+        usage = f" ({inv.usage})" if inv.usage else ""
+        await interaction.response.send_message(f"Executed {inv.backend.runner if inv.backend else inv.lang.runner} as {inv.lang.name}{usage}.", ephemeral=True)
     else:
         await interaction.response.send_message("There's no code in this message.", ephemeral=True)
 
+@bot.tree.context_menu(name="Trace")
+async def trace_menu(interaction, message: discord.Message):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("Only the bot's owner can see traces.", ephemeral=True)
+    elif (inv := await lookup(message.channel.id, message.id, message, output=True)) and inv.trace:
+        await interaction.response.send_message(f"```\n{str(inv.trace)[:1900]}```", ephemeral=True)
+    else:
+        await interaction.response.send_message("There's no trace for this message.", ephemeral=True)
+
 
 class LeftButton(discord.ui.Button):
     def __init__(self):
@@ -209,12 +389,20 @@ class ListView(discord.ui.View):
     async def on_timeout(self):
         await self.message.delete()
 
+@bot.command()
+@commands.is_owner()
+async def stats(ctx):
+    """Show the bot's metrics."""
+    text = metrics.summary() or "Nothing yet."
+    await ctx.send(f"```\n{text[:1900]}```")
+
 @bot.command()
 async def langs(ctx, *, search=None):
     """Find usable languages."""
-    langs = [l.id for l in sources.languages.values()]
     if search:
-        langs = [x for x in langs if search in x]
+        langs = catalogue.index().search(search)
+    else:
+        langs = list(sources.languages)
 
     if langs:
         view = ListView(langs)
@@ -225,11 +413,24 @@ async def langs(ctx, *, search=None):
 
 async def setup():
     global session
-    session = aiohttp.ClientSession()
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=32,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+    ), trace_configs=[tracing.config()])
     await sources.populate_languages(session)
+    await metrics.serve(int(os.environ.get("GCE_METRICS_PORT", metrics.PORT)))
     await bot.load_extension("jishaku")
     
 bot.setup_hook = setup
 
-with open("token.txt") as f:
-    bot.run(f.read().strip(), root_logger=True)
+if __name__ == "__main__":
+    with open("token.txt") as f:
+        token = f.read().strip()
+    if shards or supervisor.PROCESSES == 1:
+        bot.run(token, root_logger=True)
+        if shared:
+            shared.close()
+    else:
+        supervisor.supervise(token)
@@ -0,0 +1,130 @@
+import bisect
+import sys
+from collections import defaultdict
+
+from aiohttp import web
+
+
+PORT = 9464
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (0, 100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+registry = []
+
+
+def labelled(name, labels, suffix=""):
+    if not labels:
+        return name + suffix
+    return name + suffix + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = defaultdict(float)
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield labelled(self.name, labels), value
+
+    def summary(self):
+        for labels, value in sorted(self.values.items()):
+            yield labelled(self.name, labels), f"{value:g}"
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+        registry.append(self)
+
+    def samples(self):
+        yield self.name, self.function()
+
+    summary = samples
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count in each bucket, then above all of them], sum
+        self.values = defaultdict(lambda: [[0] * (len(buckets) + 1), 0])
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        counts, _ = entry = self.values[tuple(sorted(labels.items()))]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            running = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                running += count
+                yield labelled(self.name, labels + (("le", bound),), "_bucket"), running
+            yield labelled(self.name, labels, "_sum"), total
+            yield labelled(self.name, labels, "_count"), running
+
+    def summary(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            n = sum(counts)
+            yield labelled(self.name, labels), f"n={n} avg={total / n:.3g} p50<={self.quantile(counts, 0.5)} p99<={self.quantile(counts, 0.99)}"
+
+    def quantile(self, counts, q):
+        running = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            running += count
+            if running >= q * sum(counts):
+                return bound
+
+
+def expose():
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name} {value}" for name, value in metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    return "\n".join(f"{name} {value}" for metric in registry for name, value in metric.summary())
+
+
+async def serve(port=PORT):
+    async def handle(request):
+        return web.Response(text=expose(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # only reachable from this machine
+    try:
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+    except OSError as e:
+        # another instance or exporter has the port, which shouldn't stop the bot
+        print(f"Not serving metrics on port {port}: {e}", file=sys.stderr)
+        await runner.cleanup()
+
+
+invocations = Counter("gce_invocations_total", "Finished invocations by runner, language and outcome.")
+discord_calls = Counter("gce_discord_calls_total", "Discord API calls made by outputters.")
+invocation_seconds = Histogram("gce_invocation_seconds", "Time from starting an invocation to its output being sent.")
+backend_seconds = Histogram("gce_backend_seconds", "Time spent in a backend's execute.")
+queue_seconds = Histogram("gce_queue_wait_seconds", "Time spent waiting for a scheduler slot.")
+output_bytes = Histogram("gce_output_bytes", "Size of program output.", SIZE_BUCKETS)
@@ -1,31 +1,73 @@
+import hashlib
+
+import metrics
+
+
+def signature(content, embed, files):
+    # enough to tell whether re-sending a message would change anything
+    digests = []
+    for f in files or ():
+        with f.fp.getbuffer() as b:
+            digests.append((f.filename, hashlib.blake2b(b, digest_size=16).digest()))
+    return content, embed and embed.to_dict(), digests
+
+
 class StandardOutputter:
     def __init__(self, message):
         self.message = message
         self.output_message = None
-        self.are_reactions = False
+        # the bot's reactions on the message, in the order they were added
+        self.reactions = []
+        self.shown = None
 
-    async def send(self, *args, **kwargs):
-        self.output_message = await self.message.channel.send(*args, **kwargs)
+    async def send(self, content="", *, embed=None, files=None, **kwargs):
+        metrics.discord_calls.inc(call="send")
+        self.output_message = await self.message.channel.send(content, embed=embed, files=files, **kwargs)
+        self.shown = signature(content, embed, files)
 
     def can_edit(self):
         return self.output_message
 
-    async def edit(self, *args, **kwargs):
-        await self.output_message.edit(*args, **kwargs)
+    async def edit(self, **kwargs):
+        shown = signature(kwargs.get("content"), kwargs.get("embed"), kwargs.get("attachments"))
+        if shown == self.shown:
+            return
+        metrics.discord_calls.inc(call="edit")
+        # unknown until the edit is done, as it may be cancelled after Discord has already applied it
+        self.shown = None
+        await self.output_message.edit(**kwargs)
+        self.shown = shown
 
     async def delete(self):
         if self.output_message:
+            metrics.discord_calls.inc(call="delete")
             await self.output_message.delete()
             self.output_message = None
+            self.shown = None
 
-    async def clear_reactions(self):
-        if self.are_reactions:
+    async def set_reactions(self, wanted):
+        # removing even one reaction takes a call, so clear them all at once, which also resets users' toggles
+        if any(r not in wanted for r in self.reactions):
+            metrics.discord_calls.inc(call="clear_reactions")
             await self.message.clear_reactions()
-            self.are_reactions = False
+            self.reactions = []
+        for r in wanted:
+            if r not in self.reactions:
+                metrics.discord_calls.inc(call="add_reaction")
+                self.reactions.append(r)
+                await self.message.add_reaction(r)
+
 
-    async def add_reaction(self, reaction):
-        self.are_reactions = True
-        await self.message.add_reaction(reaction)
+# for invocations whose output is used by something other than Discord
+class NullOutputter:
+    def can_edit(self):
+        return False
+
+    async def edit(self, *args, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
 
 
 class InteractionOutputter:
@@ -34,6 +76,7 @@ class InteractionOutputter:
 
     async def edit(self, *args, **kwargs):
         # we are editing the original defer message
+        metrics.discord_calls.inc(call="edit_original_response")
         await self.interaction.edit_original_response(*args, **kwargs)
 
     def can_edit(self):
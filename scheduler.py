@@ -0,0 +1,135 @@
+import asyncio
+import contextlib
+import math
+import os
+import time
+from collections import Counter, OrderedDict, deque
+
+import metrics
+
+
+# how many programs may run at once on each runner
+LIMITS = {
+    "with TIO": 4,
+    "with ATO": 4,
+    "locally": 2,
+}
+# how many programs one user or guild may have running at once, across all runners
+PER_USER = 2
+PER_GUILD = 6
+# how many programs may wait for a slot before new ones are turned away
+MAX_QUEUE = 50
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Scheduler:
+    def __init__(self, limits, *, per_user, per_guild, max_queue):
+        self.limits = limits
+        self.per_user = per_user
+        self.per_guild = per_guild
+        self.max_queue = max_queue
+        self.running = Counter()
+        # runner -> user id -> waiting invocations, with users served round robin
+        self.queues = {}
+        self.depth = 0
+
+    def keys(self, inv):
+        guild = inv.message.guild.id if inv.message.guild else None
+        return ("runner", inv.backend.runner), ("user", inv.message.author.id), ("guild", guild)
+
+    def limit(self, kind, id):
+        if kind == "runner":
+            return self.limits.get(id, 1)
+        if kind == "user":
+            return self.per_user
+        return self.per_guild if id is not None else math.inf
+
+    def allowed(self, keys):
+        return all(self.running[key] < self.limit(*key) for key in keys)
+
+    def take(self, keys):
+        for key in keys:
+            self.running[key] += 1
+
+    def release(self, keys):
+        for key in keys:
+            self.running[key] -= 1
+            # otherwise every user and guild that ever ran anything would be kept around
+            if not self.running[key]:
+                del self.running[key]
+        self.wake()
+
+    def wake(self):
+        progress = True
+        while progress:
+            progress = False
+            for users in self.queues.values():
+                for user, waiters in list(users.items()):
+                    inv, keys, fut = waiters[0]
+                    # a cancelled waiter stays queued until its task gets to run, and is simply dropped
+                    if not fut.done() and not self.allowed(keys):
+                        continue
+                    waiters.popleft()
+                    self.depth -= 1
+                    if waiters:
+                        users.move_to_end(user)
+                    else:
+                        del users[user]
+                    progress = True
+                    if fut.done():
+                        continue
+                    self.take(keys)
+                    fut.set_result(None)
+
+    def dequeue(self, entry):
+        inv, keys, fut = entry
+        users = self.queues.get(keys[0][1], {})
+        if entry not in (waiters := users.get(inv.message.author.id, ())):
+            # already dropped by wake()
+            return
+        waiters.remove(entry)
+        if not waiters:
+            del users[inv.message.author.id]
+        self.depth -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, inv, on_queued=None, *, quotas=True):
+        start = time.monotonic()
+        # the backend can change while running (rerouting, hedging), so release what was taken
+        keys = self.keys(inv) if quotas else self.keys(inv)[:1]
+        runner = keys[0][1]
+        if not self.queues.get(runner) and self.allowed(keys):
+            self.take(keys)
+        elif self.depth >= self.max_queue:
+            raise QueueFull("Too many programs are waiting to run right now. Try again in a bit.")
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            entry = inv, keys, fut
+            self.queues.setdefault(runner, OrderedDict()).setdefault(inv.message.author.id, deque()).append(entry)
+            self.depth += 1
+            # others may be waiting only on their own quotas, leaving room for this one
+            self.wake()
+            try:
+                if on_queued and not fut.done():
+                    await on_queued()
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self.release(keys)
+                else:
+                    self.dequeue(entry)
+                raise
+        inv.queue_time = time.monotonic() - start
+        metrics.queue_seconds.observe(inv.queue_time, runner=runner)
+        try:
+            yield
+        finally:
+            self.release(keys)
+
+
+# runners are shared by every process the bot is split into, so each gets its share of their limits
+PROCESSES = int(os.environ.get("GCE_PROCESSES", 1))
+scheduler = Scheduler({runner: max(1, limit // PROCESSES) for runner, limit in LIMITS.items()}, per_user=PER_USER, per_guild=PER_GUILD, max_queue=MAX_QUEUE)
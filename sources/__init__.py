@@ -1,16 +1,284 @@
+import asyncio
+import copy
+import json
+import os
+import statistics
+import sys
+import time
 import traceback
+from collections import defaultdict, deque
 
+import metrics
+from scheduler import scheduler
 from . import tio, custom, ato
-from .common import SUCCESS, FAILED, TIMEOUT, OOM
+from .common import SUCCESS, FAILED, TIMEOUT, OOM, OUTCOMES, BackendError, Unavailable, Language, OutputBuffer, Usage
 
 
 SOURCES = (tio, ato, custom)
+SNAPSHOT = "languages.snapshot.json"
+# when a language has more than one backend and the first is slower than usual, also start the next one
+HEDGE = True
+HEDGE_MIN_DELAY = 2
+# how many recent executions each backend's health is judged by
+WINDOW = 50
+# backends that fail this many times in a row are skipped until a probe every BREAKER_COOLDOWN seconds succeeds
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+# how often remote catalogues are revalidated, and how often local ones are checked for changes
+REFRESH_INTERVAL = 30 * 60
+RELOAD_INTERVAL = 5
 
+# id -> a Language that runs on whichever of the id's backends is best
 languages = {}
+# id -> every backend's own Language for that id
+backends = {}
+# raw catalogue data and cache validators for each remote source, keyed by source name
+snapshot = {}
+# the bot's session, for probing backends outside of any invocation
+client = None
+watcher = None
 
-async def populate_languages(session):
+
+def name(source):
+    return source.__name__.rpartition(".")[2]
+
+class Health:
+    def __init__(self):
+        self.latencies = deque(maxlen=WINDOW)
+        self.failures = deque(maxlen=WINDOW)
+        self.consecutive = 0
+        # when the breaker opened, or None while the backend is in use
+        self.opened = None
+        self.probing = None
+
+    def record(self, latency, ok):
+        if ok:
+            self.latencies.append(latency)
+            self.consecutive = 0
+        else:
+            self.consecutive += 1
+            if self.consecutive >= BREAKER_THRESHOLD and self.opened is None:
+                self.opened = time.monotonic()
+        self.failures.append(not ok)
+
+    def error_rate(self):
+        return sum(self.failures) / len(self.failures) if self.failures else 0
+
+    def score(self):
+        # untried backends score best so that they get tried
+        if not self.latencies:
+            return 0
+        return statistics.median(self.latencies) * (1 + 4 * self.error_rate())
+
+    def hedge_delay(self):
+        if len(self.latencies) < 10:
+            return None
+        return max(HEDGE_MIN_DELAY, statistics.quantiles(self.latencies, n=20)[-1])
+
+
+# runner -> Health
+health = defaultdict(Health)
+
+async def probe(runner):
+    h = health[runner]
+    source = next(s for s in SOURCES if s.RUNNER == runner)
+    try:
+        ok = await source.probe(client)
+    except Exception:
+        ok = False
+    if ok:
+        h.opened = None
+        h.consecutive = 0
+    else:
+        h.opened = time.monotonic()
+    h.probing = None
+
+def available(runner):
+    h = health[runner]
+    if h.opened is None:
+        return True
+    if time.monotonic() - h.opened >= BREAKER_COOLDOWN and not h.probing and client:
+        # half open: a cheap request decides whether real ones are let through again
+        h.probing = asyncio.get_running_loop().create_task(probe(runner))
+    return False
+
+def candidates(key):
+    return sorted((l for l in backends.get(key, ()) if available(l.runner)), key=lambda l: health[l.runner].score())
+
+def route(key):
+    if not (found := candidates(key)):
+        raise Unavailable("Every backend for this language is down right now. Try again in a bit.")
+    return found
+
+def reset(inv, backend):
+    inv.backend = backend
+    inv.stdout = OutputBuffer()
+    inv.stderr = OutputBuffer()
+    inv.success = FAILED
+    inv.usage = None
+    return inv
+
+def fork(inv, backend):
+    return reset(copy.copy(inv), backend)
+
+async def attempt(inv):
+    start = time.monotonic()
+    try:
+        await inv.backend.execute(inv)
+    except BackendError:
+        health[inv.backend.runner].record(time.monotonic() - start, False)
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        health[inv.backend.runner].record(time.monotonic() - start, False)
+        raise BackendError(f"Something went wrong running this {inv.backend.runner}.") from e
+    finally:
+        metrics.backend_seconds.observe(time.monotonic() - start, runner=inv.backend.runner)
+    health[inv.backend.runner].record(time.monotonic() - start, True)
+    return inv
+
+async def elsewhere(inv):
+    # the invocation only holds a slot for the backend it was scheduled on, so others need their own.
+    # the user's and guild's quotas are already held by that slot, and waiting on them again could deadlock
+    async with scheduler.slot(inv, quotas=False):
+        return await attempt(inv)
+
+async def execute(inv):
+    others = [l for l in candidates(inv.lang.id) if l is not inv.backend]
+    delay = health[inv.backend.runner].hedge_delay()
+    if not HEDGE or not others or delay is None:
+        try:
+            return await attempt(inv)
+        except BackendError:
+            if not others:
+                raise
+        # fall back to the other backends in turn when one can't run the program at all
+        for backend in others[:-1]:
+            try:
+                return await elsewhere(reset(inv, backend))
+            except BackendError:
+                pass
+        return await elsewhere(reset(inv, others[-1]))
+
+    primary = asyncio.ensure_future(attempt(inv))
+    pending = {primary}
+    try:
+        await asyncio.wait(pending, timeout=delay)
+        # slower than usual, or failed outright
+        if not primary.done() or primary.exception():
+            pending.add(asyncio.ensure_future(elsewhere(fork(inv, others[0]))))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if error := task.exception():
+                    continue
+                inv.adopt(task.result().result())
+                return
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+def build():
+    # sources are merged in order, as later ones prefer names from earlier ones
+    found = {}
+    for source in SOURCES:
+        try:
+            source.populate_languages(snapshot.get(name(source), {}).get("data"), found)
+        except Exception:
+            traceback.print_exc()
+    # the host's own definitions replace remote ones outright, rather than being one more backend to route between
+    for key, ls in found.items():
+        if local := [l for l in ls if l.runner == custom.RUNNER]:
+            found[key] = local
+    langs = {key: Language(key, ls[0].name, execute, " or ".join(l.runner for l in ls)) for key, ls in found.items()}
+    return langs, found
+
+def load_snapshot():
+    try:
+        with open(SNAPSHOT) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_snapshot(data):
+    # several shard processes may be saving at once
+    tmp = f"{SNAPSHOT}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, SNAPSHOT)
+
+async def fetch(session, source):
+    if not (url := getattr(source, "LANGUAGES_URL", None)):
+        return False
+    old = snapshot.get(name(source), {})
+    headers = {}
+    if old.get("etag"):
+        headers["If-None-Match"] = old["etag"]
+    if old.get("last_modified"):
+        headers["If-Modified-Since"] = old["last_modified"]
+    async with session.get(url, headers=headers) as resp:
+        if resp.status == 304:
+            return False
+        resp.raise_for_status()
+        snapshot[name(source)] = {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "data": await resp.json(content_type=None),
+        }
+        return True
+
+def diff(old, new):
+    added = new.keys() - old.keys()
+    removed = old.keys() - new.keys()
+    changed = {k for k in old.keys() & new.keys() if old[k][1:] != new[k][1:]}
+    return added, removed, changed
+
+async def refresh(session, remote=True):
+    global languages, backends
+    fetched = False
+    if remote:
+        for r in await asyncio.gather(*(fetch(session, s) for s in SOURCES), return_exceptions=True):
+            if isinstance(r, Exception):
+                traceback.print_exception(r)
+            fetched = fetched or r is True
+    reloaded = False
     for source in SOURCES:
         try:
-            await source.populate_languages(session, languages)
+            reloaded = getattr(source, "reload", lambda: False)() or reloaded
         except Exception:
             traceback.print_exc()
+    if fetched or reloaded:
+        langs, found = build()
+        added, removed, changed = diff(languages, langs)
+        if added or removed or changed:
+            print(f"Languages refreshed: {len(added)} added, {len(removed)} removed, {len(changed)} changed", file=sys.stderr)
+        # swapped in one go; invocations already running keep the backend they were given
+        languages, backends = langs, found
+    if fetched:
+        await asyncio.to_thread(save_snapshot, dict(snapshot))
+
+async def watch(session):
+    last = time.monotonic()
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        remote = time.monotonic() - last >= REFRESH_INTERVAL
+        if remote:
+            last = time.monotonic()
+        try:
+            await refresh(session, remote)
+        except Exception:
+            traceback.print_exc()
+
+async def populate_languages(session):
+    global languages, backends, client, watcher
+    client = session
+    snapshot.update(await asyncio.to_thread(load_snapshot))
+    languages, backends = build()
+    if snapshot:
+        # serve the stale catalogue right away and revalidate it in the background
+        asyncio.get_running_loop().create_task(refresh(session))
+    else:
+        await refresh(session)
+    watcher = asyncio.get_running_loop().create_task(watch(session))
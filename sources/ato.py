@@ -1,28 +1,138 @@
 import asyncio
+import contextlib
+import time
+from collections import deque
+
 import aiohttp
 import msgpack
 
 from .common import *
 
 
+URL = "https://ato.pxeger.com/api/v1/ws/execute"
+RUNNER = "with ATO"
+# output streams in as the program runs, but a quiet program sends nothing until it's done after up to 60 seconds
+CONNECT_TIMEOUT = 10
+FIRST_BYTE_TIMEOUT = 70
+TOTAL_TIMEOUT = 90
+# sockets kept connected ahead of time, so that executions don't wait on TLS and the websocket upgrade
+POOL_SIZE = 2
+# idle sockets older than this are assumed dead on the server's end
+MAX_IDLE = 30
+# sockets in use at once, beyond which executions wait
+MAX_SOCKETS = 16
+
+
+class Pool:
+    def __init__(self, size, *, max_idle, max_sockets):
+        self.size = size
+        self.max_idle = max_idle
+        self.max_sockets = max_sockets
+        # (socket, when it was connected)
+        self.idle = deque()
+        self.in_use = 0
+        self.freed = asyncio.Condition()
+        self.filling = None
+        self.closing = set()
+
+    async def connect(self, session):
+        async with asyncio.timeout(CONNECT_TIMEOUT):
+            return await session.ws_connect(URL, receive_timeout=FIRST_BYTE_TIMEOUT)
+
+    def healthy(self, ws, since):
+        return not ws.closed and ws.exception() is None and time.monotonic() - since < self.max_idle
+
+    async def fill(self, session):
+        while len(self.idle) < self.size:
+            try:
+                self.idle.append((await self.connect(session), time.monotonic()))
+            except Exception:
+                return
+
+    def discard(self, ws):
+        # closing can wait on a handshake with a dead server, which no execution should sit through
+        task = asyncio.get_running_loop().create_task(ws.close())
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def take(self, session):
+        while self.idle:
+            ws, since = self.idle.popleft()
+            if self.healthy(ws, since):
+                return ws, True
+            self.discard(ws)
+        return await self.connect(session), False
+
+    @contextlib.asynccontextmanager
+    async def socket(self, session, fresh=False):
+        async with self.freed:
+            await self.freed.wait_for(lambda: self.in_use < self.max_sockets)
+            self.in_use += 1
+        try:
+            ws, pooled = (await self.connect(session), False) if fresh else await self.take(session)
+            if not self.filling or self.filling.done():
+                self.filling = asyncio.get_running_loop().create_task(self.fill(session))
+            # sockets are single use, as the server ends the connection once a program finishes
+            async with ws:
+                yield ws, pooled
+        finally:
+            async with self.freed:
+                self.in_use -= 1
+                self.freed.notify()
+
+
+pool = Pool(POOL_SIZE, max_idle=MAX_IDLE, max_sockets=MAX_SOCKETS)
+
+
+# a pooled socket turned out to have been dropped by the server before anything was received on it
+class Dropped(Exception):
+    pass
+
 async def execute(inv):
-    async with inv.session.ws_connect("https://ato.pxeger.com/api/v1/ws/execute", receive_timeout=65) as ws:
+    async with asyncio.timeout(TOTAL_TIMEOUT):
+        try:
+            await run(inv)
+        except Dropped:
+            await run(inv, fresh=True)
+
+async def run(inv, fresh=False):
+    start = time.monotonic()
+    async with pool.socket(inv.session, fresh) as (ws, pooled):
+        connected = time.monotonic()
+        # usually just taking an already connected socket from the pool
+        inv.trace.add("ato.connect", start, connected)
         msg = {
-            "language": inv.lang.id,
+            "language": inv.backend.id,
             "code": inv.code,
             "input": inv.stdin.encode(),
             "options": [x.encode() for x in inv.options],
             "arguments": [x.encode() for x in inv.args],
             "timeout": 60,
         }
-        await ws.send_bytes(msgpack.packb(msg))
+        first = None
+        try:
+            await ws.send_bytes(msgpack.packb(msg))
+            sent = time.monotonic()
+            inv.trace.add("ato.send", connected, sent)
+            resp = await ws.receive()
+        except (aiohttp.ClientError, ConnectionError) as e:
+            if pooled:
+                raise Dropped from e
+            raise
+        if resp.type not in (aiohttp.WSMsgType.BINARY, aiohttp.WSMsgType.TEXT) and pooled:
+            raise Dropped
 
-        async for resp in ws:
+        while resp.type in (aiohttp.WSMsgType.BINARY, aiohttp.WSMsgType.TEXT):
+            if first is None:
+                first = time.monotonic()
+                inv.trace.add("ato.first byte", sent, first)
             data = msgpack.unpackb(resp.data)
             if "Stdout" in data:
-                inv.stdout += data["Stdout"]
+                inv.stdout.write(data["Stdout"])
             if "Stderr" in data:
-                inv.stderr += data["Stderr"]
+                inv.stderr.write(data["Stderr"])
+            if "Stdout" in data or "Stderr" in data:
+                inv.output_received()
             if "Done" in data:
                 d = data["Done"]
                 if d["timed_out"]:
@@ -33,11 +143,18 @@ async def execute(inv):
                     inv.success = SUCCESS
                 else:
                     inv.success = FAILED
+                # times are in nanoseconds and memory in KiB
+                real, user, kernel = d.get("real"), d.get("user"), d.get("kernel")
+                inv.usage = Usage(
+                    real / 1e9 if real is not None else None,
+                    (user + kernel) / 1e9 if user is not None and kernel is not None else None,
+                    d.get("max_mem"),
+                )
+                inv.trace.add("ato.done", first, time.monotonic())
                 return
+            resp = await ws.receive()
 
-        inv.stdout = ""
-        inv.stderr = ""
-        inv.success = FAILED
+        raise BackendError("ATO closed the connection before the program finished")
 
 
 RENAMES = {
@@ -49,12 +166,16 @@ RENAMES = {
     "node": "javascript-node",
 }
 
-async def populate_languages(session, languages):
-    async with session.get("https://ato.pxeger.com/languages.json") as resp:
-        data = await resp.json()
-        for key, value in data.items():
-            # prefer names and conventions from TIO
-            better = RENAMES.get(key, key).replace("_", "-").lower()
-            name = languages[better].name if better in languages else value["name"]
+LANGUAGES_URL = "https://ato.pxeger.com/languages.json"
+
+async def probe(session):
+    async with session.head(LANGUAGES_URL, timeout=aiohttp.ClientTimeout(total=CONNECT_TIMEOUT)) as resp:
+        return resp.status < 500
+
+def populate_languages(data, languages):
+    for key, value in (data or {}).items():
+        # prefer names and conventions from TIO
+        better = RENAMES.get(key, key).replace("_", "-").lower()
+        name = languages[better][0].name if better in languages else value["name"]
 
-            languages[better] = Language(key, name, execute, "with ATO")
+        languages.setdefault(better, []).append(Language(key, name, execute, RUNNER))
@@ -6,3 +6,65 @@ SUCCESS = 0
 FAILED = 1
 TIMEOUT = 2
 OOM = 3
+OUTCOMES = ("success", "failed", "timeout", "oom")
+
+
+# raised when a backend can't run a program at all, as opposed to the program failing
+class BackendError(Exception):
+    pass
+
+# raised instead of trying when every backend for a language is known to be down
+class Unavailable(BackendError):
+    pass
+
+
+# wall and CPU time in seconds and peak memory in KiB, each None when the source doesn't say
+class Usage(namedtuple("Usage", "real cpu memory")):
+    def __str__(self):
+        parts = []
+        if self.real is not None:
+            parts.append(f"{self.real:.2f}s")
+        if self.cpu is not None:
+            parts.append(f"{self.cpu:.2f}s CPU")
+        if self.memory is not None:
+            parts.append(f"{self.memory / 1024:.1f} MiB")
+        return ", ".join(parts)
+
+# the most output kept for each stream; beyond this only the start and end are retained
+OUTPUT_LIMIT = 1 << 20
+
+
+class OutputBuffer:
+    def __init__(self, limit=None):
+        self.limit = OUTPUT_LIMIT if limit is None else limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    @property
+    def truncated(self):
+        return self.total > self.limit
+
+    def write(self, data):
+        self.total += len(data)
+        if (room := self.limit // 2 - len(self.head)) > 0:
+            self.head += data[:room]
+            data = data[room:]
+        self.tail += data
+        # trimming lazily keeps appends amortised linear
+        if len(self.tail) > self.limit:
+            del self.tail[:len(self.tail) - (self.limit - len(self.head))]
+
+    def getvalue(self):
+        if not self.truncated:
+            return bytes(self.head + self.tail)
+        tail = self.tail[len(self.tail) - (self.limit - len(self.head)):]
+        return bytes(self.head + f"\n\n[{self.total - self.limit} bytes omitted]\n\n".encode() + tail)
+
+    __bytes__ = getvalue
+
+    def __len__(self):
+        return min(self.total, self.limit)
+
+    def __bool__(self):
+        return self.total > 0
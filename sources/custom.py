@@ -1,49 +1,316 @@
 import asyncio
+import hashlib
 import io
+import json
 import os
+import shutil
+import signal
+import sys
 import time
 import shlex
-import random
 import re
+import tempfile
+from collections import OrderedDict, deque
 
 from .common import *
 
 
-TIMEOUT = 30
+RUNNER = "locally"
+# wall time allowed for each program
+TOTAL_TIMEOUT = 30
+# resource limits for each program; languages can override them with [memory=N cpu=N processes=N fsize=N]
+MEMORY_LIMIT = 1 << 30
+CPU_LIMIT = TOTAL_TIMEOUT
+# counted across every process of the bot's user, so off unless a language asks for it
+PROCESS_LIMIT = None
+FSIZE_LIMIT = 64 << 20
+# hitting RLIMIT_AS only makes allocations fail, which programs report however they like
+ALLOCATION_FAILURES = (b"MemoryError", b"Cannot allocate memory", b"out of memory", b"bad_alloc", b"memory exhausted")
+# idle workers kept for whichever language runs next.
+# workers are generic: they save starting the worker and its pipes, but the shell and the language's
+# interpreter or compiler still start on every run
+WARM = 2
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+# programs run from a fresh directory in here, preferably on tmpfs
+SCRATCH = "/dev/shm" if os.path.isdir("/dev/shm") else None
+# languages with [compile="..."] have what it writes to {out} kept here, least recently used removed first
+# absolute, as programs run from their scratch directory
+ARTIFACTS = os.path.abspath("artifacts")
+ARTIFACTS_SIZE = 512 << 20
 
-with open("languages") as f:
-    languages = {}
-    for line in f:
-        m = re.match(r"^(.*?)\((.*?)\):(.*?)$", line)
-        name = m.group(1).strip()
-        display = m.group(2).strip()
-        cmd = m.group(3).strip()
-        languages[name] = display, cmd
+LANGUAGES = "languages"
+
+# lines look like `name (Display name) [key=value ...]: command`, with the options optional.
+# compiled languages put their compile command in the options and refer to its output as {out} in both
+def parse(path):
+    langs = {}
+    with open(path) as f:
+        for line in f:
+            m = re.match(r"^(.*?)\((.*?)\)\s*(?:\[(.*)\])?\s*:(.*?)$", line)
+            name = m.group(1).strip()
+            display = m.group(2).strip()
+            options = dict(o.partition("=")[::2] for o in shlex.split(m.group(3) or ""))
+            cmd = m.group(4).strip()
+            langs[name] = display, cmd, options
+    return langs
+
+languages = {}
+# the languages file's mtime when it was last read
+modified = None
+
+
+class Workers:
+    def __init__(self, size):
+        self.size = size
+        self.idle = deque()
+        self.filling = None
+
+    async def spawn(self):
+        r, w = os.pipe()
+        try:
+            # each worker leads its own process group, so that everything the program starts can be killed with it
+            worker = await asyncio.create_subprocess_exec(
+                sys.executable, WORKER, str(w),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                start_new_session=True, pass_fds=(w,),
+            )
+        except BaseException:
+            os.close(r)
+            raise
+        finally:
+            os.close(w)
+        worker.report = r
+        return worker
+
+    async def fill(self):
+        while languages and len(self.idle) < self.size:
+            self.idle.append(await self.spawn())
+
+    def warm(self):
+        if not self.filling or self.filling.done():
+            self.filling = asyncio.get_running_loop().create_task(self.fill())
+
+    async def take(self):
+        while self.idle:
+            if (worker := self.idle.popleft()).returncode is None:
+                break
+            os.close(worker.report)
+        else:
+            worker = await self.spawn()
+        self.warm()
+        return worker
+
+    def drop(self):
+        while self.idle:
+            worker = self.idle.popleft()
+            kill(worker)
+            os.close(worker.report)
+
+
+workers = Workers(WARM)
+
+def reload():
+    global languages, modified
+    try:
+        mtime = os.stat(LANGUAGES).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime == modified:
+        return False
+    new = parse(LANGUAGES) if mtime is not None else {}
+    if not new:
+        workers.drop()
+    languages, modified = new, mtime
+    return True
+
+reload()
+
+
+def move(src, dest):
+    # the scratch directory is usually on another filesystem
+    shutil.move(src, dest)
+    return os.path.getsize(dest)
+
+def remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+class Artifacts:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        # key -> size, read from disk on first use
+        self.entries = None
+        self.size = 0
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.entries = OrderedDict()
+        for entry in sorted(os.scandir(self.path), key=lambda e: e.stat().st_mtime):
+            self.entries[entry.name] = size = entry.stat().st_size
+            self.size += size
+
+    def key(self, name, command, code, options):
+        h = hashlib.sha256()
+        for part in (name, command, *options):
+            h.update(part.encode() + b"\x00")
+        h.update(code)
+        return h.hexdigest()
+
+    def get(self, key):
+        if self.entries is None:
+            self.load()
+        if key not in self.entries:
+            return None
+        path = os.path.join(self.path, key)
+        # other processes share the directory and may have removed it
+        if not os.path.exists(path):
+            self.size -= self.entries.pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return path
+
+    async def put(self, key, src):
+        if self.entries is None:
+            self.load()
+        dest = os.path.join(self.path, key)
+        size = await asyncio.to_thread(move, src, dest)
+        self.size += size - self.entries.pop(key, 0)
+        self.entries[key] = size
+        victims = []
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            victim, size = self.entries.popitem(last=False)
+            self.size -= size
+            victims.append(os.path.join(self.path, victim))
+        if victims:
+            asyncio.get_running_loop().run_in_executor(None, remove, victims)
+        return dest
+
+
+artifacts = Artifacts(ARTIFACTS, ARTIFACTS_SIZE)
+
+def limits(name):
+    options = languages[name][2]
+    memory = int(options.get("memory", MEMORY_LIMIT))
+    cpu = int(options.get("cpu", CPU_LIMIT))
+    processes = options.get("processes", PROCESS_LIMIT)
+    fsize = int(options.get("fsize", FSIZE_LIMIT))
+    limits = {
+        "RLIMIT_AS": (memory, memory),
+        # SIGXCPU first, then SIGKILL a second later for programs that ignore it
+        "RLIMIT_CPU": (cpu, cpu + 1),
+        "RLIMIT_FSIZE": (fsize, fsize),
+    }
+    if processes is not None:
+        limits["RLIMIT_NPROC"] = (int(processes), int(processes))
+    return limits
+
+def kill(worker):
+    try:
+        os.killpg(worker.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def outcome(report, limit, stderr):
+    if report is None:
+        return TIMEOUT
+    # the worker reaps the shell, which exits with 128 + N when the program it ran was killed by signal N
+    killed = report["signal"]
+    if killed is None and report["code"] is not None and report["code"] > 128:
+        killed = report["code"] - 128
+    if killed == signal.SIGXCPU or report["cpu"] >= limit["RLIMIT_CPU"][0]:
+        return TIMEOUT
+    if report["code"] == 0:
+        return SUCCESS
+    # hitting RLIMIT_AS is the only way to run out of memory that the program can see
+    if any(x in stderr for x in ALLOCATION_FAILURES):
+        return OOM
+    return FAILED
+
+def read_report(fd):
+    try:
+        return json.loads(os.read(fd, 1 << 16) or "null")
+    finally:
+        os.close(fd)
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+async def read(stream, buf, inv=None):
+    while chunk := await stream.read(1 << 16):
+        buf.write(chunk)
+        if inv:
+            inv.output_received()
+
+async def feed(stream, data):
+    try:
+        stream.write(data)
+        await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    stream.close()
+
+async def job(command, cwd, limit, stdin, stdout, stderr, timeout, inv=None):
+    sh = await workers.take()
+    try:
+        line = json.dumps({"command": command, "cwd": cwd, "limits": limit}).encode() + b"\n"
+        start = time.monotonic()
+        # output is read incrementally rather than with communicate() so that it is never held beyond the buffer's cap
+        communicate = asyncio.gather(feed(sh.stdin, line + stdin), read(sh.stdout, stdout, inv), read(sh.stderr, stderr), sh.wait())
+        try:
+            await asyncio.wait_for(communicate, timeout=timeout)
+        except asyncio.TimeoutError:
+            kill(sh)
+            await sh.wait()
+        real = time.monotonic() - start
+        fd, sh.report = sh.report, None
+        return await asyncio.to_thread(read_report, fd), real
+    finally:
+        if sh.report is not None:
+            # cancelled partway through
+            kill(sh)
+            os.close(sh.report)
 
 async def execute(inv):
-    filename = f"code_{random.randint(1, 368307)}.{inv.lang.id}"
-    with open(filename, "wb") as f:
-        f.write(inv.code)
-    s = languages[inv.lang.id][1].format(code=filename, options=shlex.join(inv.options), args=shlex.join(inv.args), input=shlex.quote(inv.stdin))
-    sh = await asyncio.create_subprocess_shell(s, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    name = inv.backend.id
+    _, command, options = languages[name]
+    limit = limits(name)
+    deadline = time.monotonic() + TOTAL_TIMEOUT
+    scratch = await asyncio.to_thread(tempfile.mkdtemp, prefix="gce-", dir=SCRATCH)
     try:
-        stdout, stderr = await asyncio.wait_for(sh.communicate(inv.stdin.encode()), timeout=TIMEOUT)
-        inv.stdout = stdout
-        inv.stderr = stderr
-    except asyncio.TimeoutError:
-        # if we try to read the data, we're likely just to deadlock
-        sh.kill()
-    os.remove(filename)
-    match sh.returncode:
-        case 0:
-            inv.success = SUCCESS
-        case -15:
-            inv.success = OOM
-        case None:
-            inv.success = TIMEOUT
-        case _:
-            inv.success = FAILED
-
-async def populate_languages(_, langs):
-    for name, (display, _) in languages.items():
-        langs[name] = Language(name, display, execute, "locally")
+        filename = os.path.join(scratch, f"code.{name}")
+        await asyncio.to_thread(write, filename, inv.code)
+        fields = dict(code=filename, dir=scratch, options=shlex.join(inv.options), args=shlex.join(inv.args), input=shlex.quote(inv.stdin))
+        if compile := options.get("compile"):
+            key = artifacts.key(name, compile, inv.code, inv.options)
+            if not (out := artifacts.get(key)):
+                out = os.path.join(scratch, "out")
+                # the compiler's output is only shown when it fails, so that cached runs look the same
+                stdout, stderr = OutputBuffer(), OutputBuffer()
+                with inv.trace.span("local.compile"):
+                    report, real = await job(compile.format(out=out, **fields), scratch, limit, b"", stdout, stderr, deadline - time.monotonic())
+                if (success := outcome(report, limit, bytes(stderr)[-4096:])) != SUCCESS:
+                    inv.stdout, inv.stderr, inv.success = stdout, stderr, success
+                    inv.usage = Usage(real, report and report["cpu"], report and report["memory"])
+                    return
+                out = await artifacts.put(key, out)
+            fields["out"] = out
+        with inv.trace.span("local.run"):
+            report, real = await job(command.format(**fields), scratch, limit, inv.stdin.encode(), inv.stdout, inv.stderr, deadline - time.monotonic(), inv)
+    finally:
+        asyncio.get_running_loop().run_in_executor(None, shutil.rmtree, scratch, True)
+    inv.success = outcome(report, limit, bytes(inv.stderr)[-4096:])
+    inv.usage = Usage(real, report and report["cpu"], report and report["memory"])
+
+async def probe(session):
+    return True
+
+def populate_languages(_, langs):
+    for name, (display, *_) in languages.items():
+        langs.setdefault(name, []).append(Language(name, display, execute, RUNNER))
+    if languages:
+        workers.warm()
@@ -1,3 +1,6 @@
+import asyncio
+import re
+import time
 import zlib
 
 import aiohttp
@@ -5,6 +8,16 @@ import aiohttp
 from .common import *
 
 
+URL = "https://tio.run/cgi-bin/run/api/"
+RUNNER = "with TIO"
+# TIO replies all at once when the program finishes, so the first byte can take as long as the 60 second limit
+CONNECT_TIMEOUT = 10
+FIRST_BYTE_TIMEOUT = 70
+TOTAL_TIMEOUT = 90
+# requests bigger than THREAD_THRESHOLD bytes are compressed off the event loop
+COMPRESSION_LEVEL = 9
+THREAD_THRESHOLD = 1 << 16
+
 class Request:
     def __init__(self):
         self.files = []
@@ -16,38 +29,83 @@ class Request:
     def add_variable(self, name, *values):
         self.variables.append((name, values))
 
-    def render_bytes(self):
-        output = b""
+    def size(self):
+        return sum(len(v) for _, values in self.variables for v in values) + sum(len(c) for _, c in self.files)
+
+    def pieces(self):
         for name, values in self.variables:
-            output += b"V" + name + b"\x00" + f"{len(values)}".encode() + b"\x00" + b"".join(value + b"\x00" for value in values)
+            yield b"V" + name + b"\x00" + f"{len(values)}".encode() + b"\x00"
+            for value in values:
+                yield value
+                yield b"\x00"
         for name, content in self.files:
-            output += b"F" + name + b"\x00" + f"{len(content)}".encode() + b"\x00" + content + b"\x00"
-        output += b"R"
-        return zlib.compress(output, 9)[2:-4]
+            yield b"F" + name + b"\x00" + f"{len(content)}".encode() + b"\x00"
+            yield content
+            yield b"\x00"
+        yield b"R"
+
+    def render_bytes(self, level=COMPRESSION_LEVEL):
+        # raw deflate, without the zlib header and checksum
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        output = [c.compress(piece) for piece in self.pieces()]
+        output.append(c.flush())
+        return b"".join(output)
+
+
+def sections(t):
+    # the response is split into sections by the 16 byte delimiter it starts with
+    if not t:
+        return []
+    delimiter = t[:16]
+    bounds = []
+    start = 0
+    while (end := t.find(delimiter, start)) != -1:
+        if end > start:
+            bounds.append((start, end))
+        start = end + len(delimiter)
+    if start < len(t):
+        bounds.append((start, len(t)))
+    return bounds
+
+
+def stat(stats, name):
+    if m := re.search(re.escape(name) + rb": ([\d.]+) s", stats):
+        return float(m.group(1))
+    return None
 
 
 async def execute(inv):
     r = Request()
-    r.add_variable(b"lang", inv.lang.id.encode())
-    r.add_variable([b"TIO_OPTIONS", b"TIO_CFLAGS"][language_info[inv.lang.id]], *map(str.encode, inv.options))
+    r.add_variable(b"lang", inv.backend.id.encode())
+    r.add_variable([b"TIO_OPTIONS", b"TIO_CFLAGS"][language_info[inv.backend.id]], *map(str.encode, inv.options))
     r.add_variable(b"args", *map(str.encode, inv.args))
     r.add_file(b".code.tio", inv.code)
     r.add_file(b".input.tio", inv.stdin.encode())
-    d = r.render_bytes()
+    with inv.trace.span("tio.compress"):
+        d = await asyncio.to_thread(r.render_bytes) if r.size() > THREAD_THRESHOLD else r.render_bytes()
 
-    async with inv.session.post("https://tio.run/cgi-bin/run/api/", data=d) as resp:
+    timeout = aiohttp.ClientTimeout(total=TOTAL_TIMEOUT, sock_connect=CONNECT_TIMEOUT, sock_read=FIRST_BYTE_TIMEOUT)
+    marks = {}
+    start = time.monotonic()
+    async with inv.session.post(URL, data=d, timeout=timeout, trace_request_ctx=marks) as resp:
         t = await resp.read()
-        d = list(filter(bool, t.split(t[:16])))
+        inv.trace.request("tio", start, marks, time.monotonic())
+        d = sections(t)
+        if resp.status != 200 or not 1 <= len(d) <= 3:
+            raise BackendError(f"TIO responded with status {resp.status} and {len(d)} sections")
         if len(d) == 1:
-            d = b"", *d, b""
+            d = (0, 0), *d, (0, 0)
         elif len(d) == 2:
-            if b"Real time" not in d[0]:
-                d = *d, b""
+            if t.find(b"Real time", *d[0]) == -1:
+                d = *d, (0, 0)
             else:
-                d = b"", *d
+                d = (0, 0), *d
 
-    output, debug, info = d
-    inv.stdout = output
+    view = memoryview(t)
+    output, debug, info = [view[start:end] for start, end in d]
+    inv.stdout.write(output)
+    debug = bytes(debug)
+    info = bytes(info)
     *_, debug, spare = [b""] + debug.rsplit(b"\n\n", 1)
     if info == b"The request exceeded the 60 second time limit and was terminated.\n":
         inv.success = TIMEOUT
@@ -57,15 +115,24 @@ async def execute(inv):
         inv.success = SUCCESS
     else:
         inv.success = FAILED
-    inv.stderr = debug
+    inv.stderr.write(debug)
+    user, system = stat(spare, b"User time"), stat(spare, b"Sys. time")
+    inv.usage = Usage(stat(spare, b"Real time"), user + system if user is not None and system is not None else None, None)
 
 
+LANGUAGES_URL = "https://tio.run/languages.json"
 language_info = {}
 
-async def populate_languages(session, languages):
-    async with session.get("https://tio.run/languages.json") as resp:
-        for key, value in (await resp.json()).items():
-            if "dyalog" in key:
-                continue
-            languages[key] = Language(key, value["name"], execute, "with TIO")
-            language_info[key] = "cflags" in value.get("unmask", [])
+async def probe(session):
+    async with session.head(LANGUAGES_URL, timeout=aiohttp.ClientTimeout(total=CONNECT_TIMEOUT)) as resp:
+        return resp.status < 500
+
+def populate_languages(data, languages):
+    global language_info
+    info = {}
+    for key, value in (data or {}).items():
+        if "dyalog" in key:
+            continue
+        languages.setdefault(key, []).append(Language(key, value["name"], execute, RUNNER))
+        info[key] = "cflags" in value.get("unmask", [])
+    language_info = info
@@ -0,0 +1,32 @@
+# A pre-started process for the local source. Nothing about the language is loaded ahead of time.
+# It waits for one job, given as a line of JSON on stdin, then runs its command in a shell from the job's
+# directory and under its resource limits. The rest of stdin is left for the program.
+# Once the shell exits, how it exited and what it used are written as JSON to the fd given as the first argument.
+import json
+import os
+import resource
+import sys
+
+report = int(sys.argv[1])
+
+line = bytearray()
+while (c := os.read(0, 1)) and c != b"\n":
+    line += c
+if not line:
+    sys.exit()
+
+job = json.loads(line)
+if not (pid := os.fork()):
+    os.close(report)
+    os.chdir(job["cwd"])
+    for name, value in job["limits"].items():
+        resource.setrlimit(getattr(resource, name), value)
+    os.execv("/bin/sh", ["sh", "-c", job["command"]])
+
+_, status, usage = os.wait4(pid, 0)
+os.write(report, json.dumps({
+    "signal": os.WTERMSIG(status) if os.WIFSIGNALED(status) else None,
+    "code": os.WEXITSTATUS(status) if os.WIFEXITED(status) else None,
+    "cpu": usage.ru_utime + usage.ru_stime,
+    "memory": usage.ru_maxrss,
+}).encode())
@@ -0,0 +1,251 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import zlib
+from collections import OrderedDict
+
+import msgpack
+
+import metrics
+import sources
+from invocation import Invocation, THREAD_THRESHOLD
+from outputter import StandardOutputter
+
+
+# finished invocations are forgotten beyond any of these limits, least recently used first
+MAX_RECORDS = 10000
+MAX_BYTES = 64 << 20
+MAX_AGE = 7 * 24 * 60 * 60
+# writes to the on-disk store are collected and committed together this often
+FLUSH_INTERVAL = 0.5
+
+
+def decompress(data):
+    data = zlib.decompress(data)
+    # already truncated output is kept exactly as it was
+    buf = sources.OutputBuffer(len(data))
+    buf.write(data)
+    return buf
+
+
+# the parts of a finished invocation that later edits, reactions and context menus need
+class Record:
+    __slots__ = ("message", "outputter", "lang", "code", "stdin", "options", "args", "success", "backend", "usage", "send_stdout", "send_stderr", "stdout", "stderr", "trace")
+
+    def __init__(self, inv):
+        self.message = inv.message
+        self.outputter = inv.outputter
+        self.lang = inv.lang
+        self.code = inv.code
+        self.stdin = inv.stdin
+        self.options = inv.options
+        self.args = inv.args
+        self.success = inv.success
+        self.backend = inv.backend
+        self.usage = inv.usage
+        self.send_stdout = getattr(inv, "send_stdout", False)
+        self.send_stderr = getattr(inv, "send_stderr", False)
+        self.stdout = zlib.compress(bytes(inv.stdout), 1)
+        self.stderr = zlib.compress(bytes(inv.stderr), 1)
+        # kept in memory only
+        self.trace = inv.trace
+
+    @classmethod
+    def load(cls, data, message):
+        data = msgpack.unpackb(data)
+        if not (lang := sources.languages.get(data["lang"])):
+            return None
+        record = object.__new__(cls)
+        record.message = message
+        record.outputter = StandardOutputter(message)
+        record.outputter.reactions = data["reactions"]
+        if data["output"]:
+            record.outputter.output_message = message.channel.get_partial_message(data["output"])
+        record.lang = lang
+        record.code = data["code"]
+        record.stdin = data["stdin"]
+        record.options = data["options"]
+        record.args = data["args"]
+        record.success = data["success"]
+        record.backend = next((l for l in sources.backends.get(lang.id, ()) if [l.id, l.runner] == data["backend"]), None)
+        record.usage = data["usage"] and sources.Usage(*data["usage"])
+        record.send_stdout = data["send_stdout"]
+        record.send_stderr = data["send_stderr"]
+        record.stdout = data["stdout"]
+        record.stderr = data["stderr"]
+        record.trace = None
+        return record
+
+    def dump(self):
+        output = self.outputter.output_message
+        return msgpack.packb({
+            "output": output and output.id,
+            "reactions": self.outputter.reactions,
+            "lang": self.lang.id,
+            "code": self.code,
+            "stdin": self.stdin,
+            "options": list(self.options),
+            "args": list(self.args),
+            "success": self.success,
+            "backend": self.backend and [self.backend.id, self.backend.runner],
+            "usage": self.usage and list(self.usage),
+            "send_stdout": self.send_stdout,
+            "send_stderr": self.send_stderr,
+            "stdout": self.stdout,
+            "stderr": self.stderr,
+        })
+
+    @property
+    def task(self):
+        return None
+
+    def size(self):
+        return 256 + len(self.code) + len(self.stdin) + len(self.stdout) + len(self.stderr)
+
+    def invocation(self, session=None):
+        inv = Invocation(session, self.message, self.lang, self.code, outputter=self.outputter, stdin=self.stdin, options=self.options, args=self.args)
+        inv.stdout = decompress(self.stdout)
+        inv.stderr = decompress(self.stderr)
+        inv.success = self.success
+        inv.backend = self.backend
+        inv.usage = self.usage
+        inv.send_stdout = self.send_stdout
+        inv.send_stderr = self.send_stderr
+        return inv
+
+    async def send_output(self):
+        if len(self.stdout) + len(self.stderr) > THREAD_THRESHOLD:
+            inv = await asyncio.to_thread(self.invocation)
+        else:
+            inv = self.invocation()
+        await inv.send_output()
+
+
+class Store:
+    def __init__(self, *, max_records, max_bytes, max_age):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # message id -> (time stored, size, invocation or record)
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, message_id):
+        if not (entry := self.entries.get(message_id)):
+            return None
+        if entry[0] + self.max_age < time.monotonic():
+            self.pop(message_id)
+            return None
+        self.entries.move_to_end(message_id)
+        return entry[2]
+
+    def __setitem__(self, message_id, value):
+        self.pop(message_id)
+        # running invocations are small until they finish and are compacted
+        size = value.size() if isinstance(value, Record) else 0
+        self.entries[message_id] = time.monotonic(), size, value
+        self.size += size
+        while len(self.entries) > self.max_records or self.size > self.max_bytes:
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, message_id):
+        if entry := self.entries.pop(message_id, None):
+            self.size -= entry[1]
+            return entry[2]
+        return None
+
+
+# records shared between the processes of a sharded bot, keyed by message id
+class Shared:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS records (message_id INTEGER PRIMARY KEY, output_id INTEGER, stored REAL NOT NULL, data BLOB NOT NULL);
+            CREATE INDEX IF NOT EXISTS records_output ON records (output_id);
+            CREATE INDEX IF NOT EXISTS records_stored ON records (stored);
+        """)
+        # message id -> (output message id, record) waiting to be written, or None to be deleted
+        self.pending = {}
+        self.writing = {}
+        self.flushing = None
+
+    def run(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchone()
+
+    def write(self, batch):
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for message_id, entry in batch.items():
+                    if entry:
+                        self.db.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)", (message_id, entry[0], now, entry[1]))
+                    else:
+                        self.db.execute("DELETE FROM records WHERE message_id = ?", (message_id,))
+                self.db.execute("DELETE FROM records WHERE stored < ?", (now - MAX_AGE,))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        while self.pending:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.writing, self.pending = self.pending, {}
+            try:
+                await asyncio.to_thread(self.write, self.writing)
+            except Exception:
+                traceback.print_exc()
+            self.writing = {}
+
+    def close(self):
+        self.write(self.writing | self.pending)
+        self.db.close()
+
+    def queue(self, message_id, entry):
+        self.pending[message_id] = entry
+        if not self.flushing or self.flushing.done():
+            self.flushing = asyncio.get_running_loop().create_task(self.flush())
+
+    def put(self, message_id, record):
+        output = record.outputter.output_message
+        self.queue(message_id, (output and output.id, record.dump()))
+
+    def delete(self, message_id):
+        self.queue(message_id, None)
+
+    def unwritten(self, message_id):
+        for batch in (self.pending, self.writing):
+            if message_id in batch:
+                return batch[message_id]
+        return False
+
+    async def get(self, message_id):
+        if (entry := self.unwritten(message_id)) is not False:
+            return entry and entry[1]
+        row = await asyncio.to_thread(self.run, "SELECT data FROM records WHERE message_id = ?", message_id)
+        return row and row[0]
+
+    async def source(self, output_id):
+        # the message whose output this is, as (message id, record)
+        for batch in (self.pending, self.writing):
+            for message_id, entry in batch.items():
+                if entry and entry[0] == output_id:
+                    return message_id, entry[1]
+        return await asyncio.to_thread(self.run, "SELECT message_id, data FROM records WHERE output_id = ?", output_id)
+
+
+results = Store(max_records=MAX_RECORDS, max_bytes=MAX_BYTES, max_age=MAX_AGE)
+# set by the supervisor when the bot runs as several processes, or by the host to keep invocations across restarts
+shared = Shared(path) if (path := os.environ.get("GCE_STORE") or os.environ.get("GCE_SHARED_STORE")) else None
+metrics.Gauge("gce_results", "Invocations kept for later edits and reactions.", lambda: len(results))
+metrics.Gauge("gce_results_bytes", "Approximate memory used by kept invocations.", lambda: results.size)
@@ -0,0 +1,87 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+
+# how many processes to split the bot's shards between; with 1, the bot runs in this process as it always has
+PROCESSES = int(os.environ.get("GCE_PROCESSES", 1))
+SHARED_STORE = "shared.sqlite3"
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+# crashed processes are restarted, waiting longer each time they crash in quick succession
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+
+def recommended_shards(token):
+    request = urllib.request.Request("https://discord.com/api/v10/gateway/bot", headers={
+        "Authorization": f"Bot {token}",
+        "User-Agent": "DiscordBot (https://github.com/LyricLy/gce.py, 1.0)",
+    })
+    with urllib.request.urlopen(request) as resp:
+        return json.load(resp)["shards"]
+
+def ranges(shard_count, processes):
+    per, extra = divmod(shard_count, processes)
+    start = 0
+    for i in range(processes):
+        end = start + per + (i < extra)
+        yield start, end - 1
+        start = end
+
+def supervise(token, processes=PROCESSES):
+    shard_count = int(os.environ.get("GCE_SHARD_COUNT") or recommended_shards(token))
+    shards = list(ranges(shard_count, min(processes, shard_count)))
+
+    # the shared store only lives as long as the processes sharing it
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(SHARED_STORE + suffix)
+        except FileNotFoundError:
+            pass
+
+    def spawn(i):
+        first, last = shards[i]
+        env = os.environ | {
+            "GCE_SHARDS": f"{first}-{last}",
+            "GCE_SHARD_COUNT": str(shard_count),
+            # how many processes there really are, which the scheduler splits runner limits between
+            "GCE_PROCESSES": str(len(shards)),
+            "GCE_SHARED_STORE": SHARED_STORE,
+            "GCE_METRICS_PORT": str(int(os.environ.get("GCE_METRICS_PORT", 9464)) + i),
+        }
+        return subprocess.Popen([sys.executable, MAIN], env=env)
+
+    children = [spawn(i) for i in range(len(shards))]
+    started = [time.monotonic()] * len(shards)
+    backoff = [MIN_BACKOFF] * len(shards)
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for child in children:
+            child.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        for i, child in enumerate(children):
+            if child.poll() is None:
+                continue
+            print(f"Shards {shards[i][0]}-{shards[i][1]} exited with {child.returncode}, restarting", file=sys.stderr)
+            if time.monotonic() - started[i] > MAX_BACKOFF:
+                backoff[i] = MIN_BACKOFF
+            time.sleep(backoff[i])
+            backoff[i] = min(backoff[i] * 2, MAX_BACKOFF)
+            if not stopping:
+                children[i] = spawn(i)
+                started[i] = time.monotonic()
+        time.sleep(1)
+
+    for child in children:
+        child.wait()
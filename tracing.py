@@ -0,0 +1,68 @@
+import contextlib
+import json
+import logging
+import random
+import time
+
+import aiohttp
+
+
+# the fraction of traces that are logged; every trace is kept with its invocation regardless
+SAMPLE_RATE = 0.05
+
+log = logging.getLogger("gce.trace")
+
+
+class Trace:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.started = time.time()
+        self.sampled = random.random() < SAMPLE_RATE
+        self.spans = []
+
+    def add(self, name, start, end, **fields):
+        self.spans.append({"name": name, "start": round(start - self.start, 6), "duration": round(end - start, 6), **fields})
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic(), **fields)
+
+    def request(self, prefix, start, marks, end):
+        # marks are collected by the session's trace config for requests made with trace_request_ctx=marks
+        sending = start
+        if "connecting" in marks and "connected" in marks:
+            self.add(f"{prefix}.connect", marks["connecting"], marks["connected"])
+            sending = marks["connected"]
+        sent = marks.get("sent", sending)
+        received = marks.get("received", sent)
+        self.add(f"{prefix}.send", sending, sent)
+        self.add(f"{prefix}.first byte", sent, received)
+        self.add(f"{prefix}.done", received, end)
+
+    def emit(self, **fields):
+        if self.sampled:
+            log.info(json.dumps({"time": self.started, **fields, "spans": self.spans}))
+
+    def __str__(self):
+        return "\n".join(f"{s['start'] * 1000:9.1f}ms {s['duration'] * 1000:9.1f}ms  {s['name']}" for s in self.spans)
+
+
+def config():
+    trace = aiohttp.TraceConfig()
+
+    def mark(name):
+        async def on(session, context, params):
+            if isinstance(context.trace_request_ctx, dict):
+                context.trace_request_ctx[name] = time.monotonic()
+        return on
+
+    trace.on_connection_create_start.append(mark("connecting"))
+    trace.on_connection_create_end.append(mark("connected"))
+    trace.on_request_chunk_sent.append(mark("sent"))
+    # once the response's headers are in
+    trace.on_request_end.append(mark("received"))
+    return trace